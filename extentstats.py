@@ -1,15 +1,24 @@
 import sys, os
 import argparse
 from collections import namedtuple
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from datetime import datetime, timedelta
+import gzip
 import json
+import math
+import queue
+import random
 import shutil
+import threading
+import time
 
 import boto3
 import humanize
+import pyarrow.parquet as pq
 import requests
 from requests.adapters import HTTPAdapter, Retry
-from urllib.parse import quote, urlparse
+from urllib.parse import quote, unquote, urlparse
 import xlsxwriter
 
 CAMPUSES = os.environ.get('CAMPUSES')
@@ -18,6 +27,9 @@ METADATA = os.environ.get('NUXEO_EXTENT_STATS_METADATA')
 REPORTS = os.environ.get('NUXEO_EXTENT_STATS_REPORTS')
 TEMP = os.environ.get('NUXEO_EXTENT_STATS_LOCAL_TEMPDIR')
 
+# max fraction of files that can be missing from a blob inventory
+INVENTORY_MAX_MISSING = float(os.environ.get('NUXEO_EXTENT_STATS_INVENTORY_MAX_MISSING', 0.01))
+
 NUXEO_DBQUERY_URL = os.environ['NUXEO_DBQUERY_URL']
 NUXEO_DBQUERY_TOKEN = os.environ['NUXEO_DBQUERY_TOKEN']
 
@@ -35,14 +47,14 @@ def parse_data_uri(data_uri: str):
 
 DATA = parse_data_uri(METADATA)
 
-def configure_http_session() -> requests.Session:
+def configure_http_session(pool_size: int = 10) -> requests.Session:
     http = requests.Session()
     retry_strategy = Retry(
         total=3,
         backoff_factor=6,
         status_forcelist=[413, 429, 500, 502, 503, 504]
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    adapter = HTTPAdapter(max_retries=retry_strategy, pool_maxsize=pool_size)
     http.mount("https://", adapter)
     http.mount("http://", adapter)
     return http
@@ -177,14 +189,21 @@ def get_campus_folders_from_storage(campus, version):
     return folders
 
 MD5S = []
-def create_extent_report(campus, version):
+def create_extent_report(campus, version, page_queue=None, inventory=None):
     '''
     for a given campus:
-        - get metadata files for campus from S3
-        - parse out file stats metadata
+        - get metadata files for campus from S3, or pages of records
+          from page_queue as they are fetched (see stream_extent_report)
+        - parse out file stats metadata, either from the Nuxeo API or,
+          if a blob inventory is given, from the stored metadata itself
+          with sizes joined from the inventory by digest
         - create spreadsheet of stats
     '''
 
+    # inventory lookups are tracked per report
+    INVENTORY_DIGESTS.clear()
+    MISSING_DIGESTS.clear()
+
     # create the excel excel_workbook
     tmp_dir = TEMP
     if not os.path.exists(tmp_dir):
@@ -240,13 +259,12 @@ def create_extent_report(campus, version):
         "total_size": 0
     }
 
-    folders = get_campus_folders_from_storage(campus, version)
-
-    for folder in folders:
-        print(f"Aggregating stats for {folder}")
-        stats = get_stats(campus, version, folder)
+    if page_queue is None:
+        folder_stats = get_folder_stats_from_storage(campus, version, inventory)
+    else:
+        folder_stats = get_folder_stats_from_queue(campus, page_queue, doclist_file_path, inventory)
 
-        rowname = folder.split('/')[-1]
+    for rowname, stats in folder_stats:
         write_stats(stats, summary_worksheet, row, rowname)
         row += 1
 
@@ -273,9 +291,29 @@ def create_extent_report(campus, version):
 
     summary_stats['doc_count'] = summary_doc_count
 
+    if inventory is not None and INVENTORY_DIGESTS:
+        missing_rate = len(MISSING_DIGESTS) / len(INVENTORY_DIGESTS)
+        if missing_rate > INVENTORY_MAX_MISSING:
+            excel_workbook.close()
+            os.remove(excel_file_path)
+            if os.path.exists(doclist_file_path):
+                os.remove(doclist_file_path)
+            raise Exception(
+                f"{len(MISSING_DIGESTS)} of {len(INVENTORY_DIGESTS)} files "
+                f"({missing_rate:.1%}) not found in inventory; is the inventory complete?"
+            )
+
     rowname = 'TOTALS'
     write_stats(summary_stats, summary_worksheet, row, rowname)
 
+    if MISSING_DIGESTS:
+        note = (
+            f"{len(MISSING_DIGESTS)} of {len(INVENTORY_DIGESTS)} files not found "
+            "in inventory; they are counted with a size of 0"
+        )
+        print(f"WARNING: {note}")
+        summary_worksheet.write_string(row + 2, 0, note)
+
     excel_workbook.close()
 
     # write files to storage
@@ -304,11 +342,267 @@ def create_extent_report(campus, version):
     os.remove(doclist_file_path)
 
 
-def get_stats(campus, version, folder):
+EXTENT_ESTIMATE_FIELDS = [
+    ("main_count", "Unique Main File Count"),
+    ("main_size", "Main File Size"),
+    ("filetab_count", "Unique Files Tab Count"),
+    ("filetab_size", "Files Tab Size"),
+    ("aux_count", "Unique Aux File Count"),
+    ("aux_size", "Aux File Size"),
+    ("deriv_count", "Unique Derivative File Count"),
+    ("deriv_size", "Derivative File Size"),
+    ("total_count", "Total Unique File Count"),
+    ("total_size", "Total File Size")
+]
 
-    doc_count = 0
+# z-score for a 95% confidence interval
+CONFIDENCE_Z = 1.96
+
+def create_extent_estimate(campus, version, sample_size):
+    '''
+    for a given campus:
+        - get record listings, either from storage (if version is given)
+          or by paging through the dbquery listings for each folder
+        - draw a stratified random sample of sample_size records per folder
+        - get extent for the sampled records only
+        - extrapolate doc counts, file counts and sizes, with 95%
+          confidence intervals
+        - estimate the runtime of a full report
+        - write a text summary of the estimate to storage
+
+    Listings fetched from dbquery contain top-level records only (no
+    components). In that case each sampled record is treated as a cluster
+    of the record and all of its components, so that files on the
+    components are included in the estimate.
+    '''
+    if version:
+        from_storage = True
+        listing_seconds = 0
+        listings = {}
+        for folder in get_campus_folders_from_storage(campus, version):
+            listings[folder.split('/')[-1]] = list(get_folder_listing(campus, version, folder))
+    else:
+        from_storage = False
+        version = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        start = time.monotonic()
+        listings = get_campus_listings_from_nuxeo(campus)
+        listing_seconds = time.monotonic() - start
+
+    fields = [("doc_count", "Doc Count")] + EXTENT_ESTIMATE_FIELDS
+
+    estimate = {key: 0 for key, label in fields}
+    variance = {key: 0 for key, label in fields}
+    record_count = 0
+    sampled_count = 0
+    sampled_docs = 0
+    api_seconds = 0
+    component_seconds = 0
+    folder_lines = []
+
+    for folder, listing in listings.items():
+        population = len(listing)
+        if not population:
+            continue
+        sample = random.sample(listing, min(sample_size, population))
+        print(f"Sampling {len(sample)} of {population} records for {folder}")
+
+        extents = []
+        for doc in sample:
+            record = json.loads(doc)
+            docs = [record]
+            if not from_storage:
+                start = time.monotonic()
+                docs.extend(get_components(record))
+                component_seconds += time.monotonic() - start
+
+            extent = {key: 0 for key, label in fields}
+            extent['doc_count'] = len(docs)
+            for d in docs:
+                start = time.monotonic()
+                doc_extent = get_extent(hit_nuxeo_api(d['uid']))
+                api_seconds += time.monotonic() - start
+                for key, label in EXTENT_ESTIMATE_FIELDS:
+                    extent[key] += doc_extent[key]
+            extents.append(extent)
+            sampled_docs += len(docs)
+
+        folder_estimate = extrapolate_extents(extents, population, fields)
+        for key, label in fields:
+            estimate[key] += folder_estimate[key][0]
+            variance[key] += folder_estimate[key][1]
+
+        record_count += population
+        sampled_count += len(sample)
+        total_size, total_size_variance = folder_estimate['total_size']
+        folder_lines.append(
+            f"{folder}: {population} records, "
+            f"{format_estimate('total_size', total_size, total_size_variance)}"
+        )
+
+    lines = [
+        f"{campus} extent estimate {version}",
+        f"Sampled {sampled_count} of {record_count} records "
+        f"(up to {sample_size} per folder), {sampled_docs} docs including components"
+    ]
+    for key, label in fields:
+        lines.append(f"{label}: {format_estimate(key, estimate[key], variance[key])}")
+
+    if sampled_count:
+        # every doc, including components, gets one Nuxeo API call in a full run
+        report_seconds = api_seconds / sampled_docs * estimate['doc_count']
+        fetch_seconds = listing_seconds + component_seconds / sampled_count * record_count
+        if from_storage:
+            lines.append(
+                "Estimated full report runtime from stored metadata: "
+                f"{humanize.naturaldelta(timedelta(seconds=report_seconds))}"
+            )
+        else:
+            lines.append(
+                "Estimated full run time: "
+                f"{humanize.naturaldelta(timedelta(seconds=fetch_seconds + report_seconds))} "
+                f"(fetch {humanize.naturaldelta(timedelta(seconds=fetch_seconds))}, "
+                f"report {humanize.naturaldelta(timedelta(seconds=report_seconds))})"
+            )
 
-    stats = {
+    lines.append("")
+    lines.append("Total File Size by Project Folder")
+    lines.extend(folder_lines)
+
+    content = "\n".join(lines) + "\n"
+    print(content)
+
+    # write estimate to storage
+    estimate_file_name = f"{campus}-extent-estimate-{version}.txt"
+    data = parse_data_uri(REPORTS)
+    if data.store == 's3':
+        key = f"{data.path}/{campus}/{version}/{estimate_file_name}".lstrip('/')
+        load_object_to_s3(data.bucket, key, content)
+    elif data.store == 'file':
+        dest_dir = os.path.join(data.path, campus, version)
+        write_object_to_local(dest_dir, estimate_file_name, content)
+    else:
+        raise Exception(f"Unknown data scheme: {data.store}")
+
+def get_campus_listings_from_nuxeo(campus):
+    '''
+    Page through the dbquery record listings for every folder in a campus
+    without writing anything to storage. Nested folders are grouped into
+    their top-level folder, as they are in the extent report.
+
+    Returns a dict of top-level folder name to a list of json strings,
+    one per record
+    '''
+    path = f"/asset-library/{campus}"
+    uid = get_nuxeo_uid_for_path(path)
+    listings = {}
+    for folder in fetch_folders({'uid': uid}):
+        next_page = True
+        resume_after = ''
+        records = []
+        while next_page:
+            resp = query_nuxeo_db_directly(folder, 'records', 'listing', resume_after)
+            next_page = resp.json().get('isNextPageAvailable')
+            resume_after = resp.json().get('resumeAfter')
+            entries = resp.json().get('entries', [])
+            if not entries:
+                next_page = False
+                continue
+            records.extend([json.dumps(entry) for entry in entries])
+        rowname = folder['path'].removeprefix(f'{path}/').split('/')[0]
+        listings.setdefault(rowname, []).extend(records)
+
+    return listings
+
+def get_components(record):
+    ''' Get all components of a record, at any level of nesting '''
+    components = []
+    for page in get_pages_of_child_components(record):
+        for component in page.get('entries', []):
+            components.append(component)
+            components.extend(get_components(component))
+
+    return components
+
+def extrapolate_extents(extents, population, fields=EXTENT_ESTIMATE_FIELDS):
+    '''
+    Extrapolate a simple random sample of doc extents to the whole folder.
+
+    Returns a dict of extent key to (estimated total, variance of the
+    estimate), using the finite population correction.
+    '''
+    n = len(extents)
+    results = {}
+    for key, label in fields:
+        values = [extent[key] for extent in extents]
+        mean = sum(values) / n
+        if n == population:
+            variance = 0
+        else:
+            sample_variance = sum((v - mean) ** 2 for v in values) / (n - 1)
+            fpc = 1 - n / population
+            variance = population ** 2 * fpc * sample_variance / n
+        results[key] = (population * mean, variance)
+
+    return results
+
+def format_estimate(key, value, variance):
+    margin = CONFIDENCE_Z * math.sqrt(variance)
+    if key.endswith('_size'):
+        return (
+            f"{humanize.naturalsize(value, binary=True)} "
+            f"(+/- {humanize.naturalsize(margin, binary=True)})"
+        )
+    return f"{round(value)} (+/- {round(margin)})"
+
+def get_folder_stats_from_storage(campus, version, inventory=None):
+    '''
+    Yield (rowname, stats) for each top-level folder in storage
+    '''
+    folders = get_campus_folders_from_storage(campus, version)
+
+    for folder in folders:
+        print(f"Aggregating stats for {folder}")
+        yield folder.split('/')[-1], get_stats(campus, version, folder, inventory)
+
+def get_folder_stats_from_queue(campus, page_queue, doclist_file_path, inventory=None):
+    '''
+    Aggregate stats for pages of records as they come off the queue,
+    until the crawl signals it is done by putting None on the queue.
+    If the crawl failed, its exception is put on the queue instead.
+
+    Docs are written to the doclist file page by page rather than kept
+    in memory, so the returned stats have empty doc lists.
+
+    Returns a list of (rowname, stats), one per top-level folder
+    '''
+    folder_stats = {}
+    while True:
+        item = page_queue.get()
+        if item is None:
+            break
+        if isinstance(item, Exception):
+            raise item
+
+        path, records = item
+        rowname = path.removeprefix(f'/asset-library/{campus}/').split('/')[0]
+        if rowname not in folder_stats:
+            print(f"Aggregating stats for {rowname}")
+            folder_stats[rowname] = new_stats()
+        stats = folder_stats[rowname]
+        for record in records:
+            stats = add_doc_to_stats(stats, json.dumps(record), inventory)
+            stats['doc_count'] += 1
+
+        with open(doclist_file_path, "a") as f:
+            for doc in stats['docs']:
+                f.write(f"{doc}")
+        stats['docs'] = []
+
+    return list(folder_stats.items())
+
+def new_stats():
+    return {
+        "doc_count": 0,
         "main_count": 0,
         "main_size": 0,
         "filetab_count": 0,
@@ -322,6 +616,27 @@ def get_stats(campus, version, folder):
         "docs": []
     }
 
+def get_stats(campus, version, folder, inventory=None):
+
+    doc_count = 0
+
+    stats = new_stats()
+
+    for line in get_folder_listing(campus, version, folder):
+        stats = add_doc_to_stats(stats, line, inventory)
+        doc_count += 1
+
+    # Total Items (including components of complex objects; some may not have associated files)
+    stats['doc_count'] = doc_count
+
+    return stats
+
+def get_folder_listing(campus, version, folder):
+    '''
+    Metadata has already been fetched to storage (S3 or local);
+    yield each line (one record listing) stored under the given folder,
+    including any component pages in nested directories
+    '''
     data = parse_data_uri(METADATA)
     if data.store == 'file':
         metadata_dir = os.path.join(data.path, campus, version, folder)
@@ -330,8 +645,7 @@ def get_stats(campus, version, folder):
                 filepath = os.path.join(root, file)
                 with open(filepath, "r") as f:
                     for line in f.readlines():
-                        stats = add_doc_to_stats(stats, line)
-                        doc_count += 1
+                        yield line
     elif data.store == 's3':
         s3_client = boto3.client('s3')
         paginator = s3_client.get_paginator('list_objects_v2')
@@ -347,22 +661,25 @@ def get_stats(campus, version, folder):
                     Key=item['Key']
                 )
                 for line in response['Body'].iter_lines():
-                    stats = add_doc_to_stats(stats, line)
-                    doc_count += 1
+                    yield line
     else:
         raise Exception(f"Unknown data scheme: {data.store}")
 
-    # Total Items (including components of complex objects; some may not have associated files)
-    stats['doc_count'] = doc_count
-
-    return stats
-
-def add_doc_to_stats(stats, doc):
+def add_doc_to_stats(stats, doc, inventory=None):
 
-    # Query database using Nuxeo API to get full metadata
-    uid = json.loads(doc)['uid']
-    full_metadata = hit_nuxeo_api(uid)
-    doc_extent = get_extent(full_metadata)
+    if inventory is None:
+        # Query database using Nuxeo API to get full metadata
+        uid = json.loads(doc)['uid']
+        full_metadata = hit_nuxeo_api(uid)
+    else:
+        # Stored records already have full metadata; sizes come from the inventory
+        full_metadata = json.loads(doc)
+        if 'properties' not in full_metadata:
+            raise Exception(
+                f"No properties for {full_metadata['uid']} in stored metadata. "
+                "Metadata must be fetched with --inventory to use an inventory."
+            )
+    doc_extent = get_extent(full_metadata, inventory)
 
     stats['docs'].append(f"{full_metadata['uid']}, {full_metadata['path']}\n")
     stats['main_count'] += doc_extent['main_count']
@@ -378,7 +695,7 @@ def add_doc_to_stats(stats, doc):
 
     return stats
 
-def get_extent(doc):
+def get_extent(doc, inventory=None):
     extent = {
         "main_count": 0,
         "main_size": 0,
@@ -399,7 +716,7 @@ def get_extent(doc):
         if not content['digest'] in MD5S:
             MD5S.append(content['digest'])
             extent['main_count'] += 1
-            extent['main_size'] += int(content['length'])
+            extent['main_size'] += blob_length(content, inventory)
             #print(f"main {extent['main_count']} file:content {content['name']} {int(content['length'])}")
 
     # Original files vs file:content?
@@ -409,7 +726,7 @@ def get_extent(doc):
             if not content['digest'] in MD5S:
                 MD5S.append(content['digest'])
                 extent['deriv_count'] += 1
-                extent['deriv_size'] += int(content['length'])
+                extent['deriv_size'] += blob_length(content, inventory)
                 #print(f"deriv {extent['deriv_count']} picture:views {content['name']} {view['description']} {int(content['length'])}")
 
     # extra_files:file
@@ -420,7 +737,7 @@ def get_extent(doc):
                 blob = f.get('blob')
                 MD5S.append(blob['digest'])
                 extent['aux_count'] += 1
-                extent['aux_size'] += int(blob['length'])
+                extent['aux_size'] += blob_length(blob, inventory)
                 #print(f"aux {extent['aux_count']} extra_files {blob['name']} {int(blob['length'])}")
 
     # files:files
@@ -430,7 +747,7 @@ def get_extent(doc):
             if file.get('file') and not file['file']['digest'] in MD5S:
                 file = file.get('file')
                 extent['filetab_count'] += 1
-                extent['filetab_size'] += int(file['length'])
+                extent['filetab_size'] += blob_length(file, inventory)
                 #print(f"filetab {extent['filetab_count']} files:files {file['name']} {int(file['length'])}")
 
     # vid:storyboard
@@ -440,7 +757,7 @@ def get_extent(doc):
             if board.get('content') and not board['content']['digest'] in MD5S:
                 content = board.get('content')
                 extent['deriv_count'] += 1
-                extent['deriv_size'] += int(content['length'])
+                extent['deriv_size'] += blob_length(content, inventory)
                 #print(f"deriv {extent['deriv_count']} storyboard {content['name']} {int(content['length'])}")
 
     # vid:transcodedVideos
@@ -450,7 +767,7 @@ def get_extent(doc):
             if vid.get('content') and not vid['content']['digest'] in MD5S:
                 content = vid.get('content')
                 extent['deriv_count'] += 1
-                extent['deriv_size'] += int(content['length'])
+                extent['deriv_size'] += blob_length(content, inventory)
                 #print(f"deriv {extent['deriv_count']} vid:transcodedVideos {content['name']} {int(content['length'])}")
 
     # auxiliary_files:file
@@ -460,7 +777,7 @@ def get_extent(doc):
             if af.get('content') and not af['content']['digest'] in MD5S:
                 content = af.get('content')
                 extent['deriv_count'] += 1
-                extent['deriv_size'] += int(content['length'])
+                extent['deriv_size'] += blob_length(content, inventory)
 
     # 3D
     if properties.get('threed:transmissionFormats'):
@@ -469,13 +786,163 @@ def get_extent(doc):
             if format.get('content') and not format['content']['digest'] in MD5S:
                 content = format.get('content')
                 extent['deriv_count'] += 1
-                extent['deriv_size'] += int(content['length'])
+                extent['deriv_size'] += blob_length(content, inventory)
 
     extent['total_count'] = extent['main_count'] + extent['filetab_count'] + extent['deriv_count'] + extent['aux_count']
     extent['total_size'] = extent['main_size'] + extent['filetab_size'] + extent['deriv_size'] + extent['aux_size']
 
     return extent
 
+INVENTORY_DIGESTS = set()
+MISSING_DIGESTS = set()
+def blob_length(blob, inventory=None):
+    '''
+    Length of a blob, either as reported by nuxeo or, if an inventory
+    is given, as looked up by digest in the binary store inventory
+    '''
+    if inventory is None:
+        return int(blob['length'])
+
+    INVENTORY_DIGESTS.add(blob['digest'])
+    length = inventory.get(blob['digest'])
+    if length is None:
+        MISSING_DIGESTS.add(blob['digest'])
+        return 0
+    return length
+
+def load_blob_inventory(inventory_uri):
+    '''
+    Load an inventory of the nuxeo binary store into a dict of
+    digest -> length, to be joined against the blobs in stored records.
+
+    The inventory can be a local path, a file:// uri or an s3:// uri, in
+    one of these formats:
+        - an S3 Inventory manifest.json, with csv or parquet data files.
+          The data files are read from the manifest's destination bucket
+          or, for a local manifest, from the data directory alongside the
+          manifest's directory, as S3 Inventory lays them out.
+        - a csv (optionally gzipped) with a header row naming a digest
+          (or key) column and a length (or size) column
+        - a parquet file with digest (or key) and length (or size)
+          columns
+
+    Binary store keys may have a prefix; the digest is the last part of the key.
+    '''
+    filepath, downloaded = get_inventory_file(inventory_uri)
+
+    inventory = {}
+    if filepath.endswith('manifest.json'):
+        with open(filepath, "r") as f:
+            manifest = json.load(f)
+
+        file_format = manifest['fileFormat'].lower()
+        if file_format == 'csv':
+            columns = [column.strip() for column in manifest['fileSchema'].split(',')]
+        elif file_format != 'parquet':
+            raise Exception(f"Unsupported inventory format: {manifest['fileFormat']}")
+
+        bucket = manifest['destinationBucket'].split(':')[-1]
+        inventory_dir = os.path.dirname(os.path.dirname(os.path.abspath(filepath)))
+        for file in manifest['files']:
+            if parse_data_uri(inventory_uri).store == 's3':
+                data_file_uri = f"s3://{bucket}/{file['key']}"
+            else:
+                data_file_uri = os.path.join(inventory_dir, 'data', os.path.basename(file['key']))
+            data_file_path, data_file_downloaded = get_inventory_file(data_file_uri)
+            if file_format == 'csv':
+                add_rows_to_inventory(inventory, read_csv_inventory(data_file_path, columns))
+            else:
+                add_rows_to_inventory(inventory, read_parquet_inventory(data_file_path))
+            if data_file_downloaded:
+                os.remove(data_file_path)
+        print(f"Loaded {len(inventory)} blobs from {len(manifest['files'])} inventory files")
+    elif filepath.endswith('.parquet'):
+        add_rows_to_inventory(inventory, read_parquet_inventory(filepath))
+        print(f"Loaded {len(inventory)} blobs from inventory")
+    else:
+        add_rows_to_inventory(inventory, read_csv_inventory(filepath))
+        print(f"Loaded {len(inventory)} blobs from inventory")
+
+    if downloaded:
+        os.remove(filepath)
+
+    return inventory
+
+def get_inventory_file(inventory_uri):
+    '''
+    Get a local path for an inventory file, downloading it to the
+    temp dir if it is in S3
+
+    Returns a tuple of (path, whether the file was downloaded)
+    '''
+    data = parse_data_uri(inventory_uri)
+    if data.store == 's3':
+        tmp_dir = TEMP
+        if not os.path.exists(tmp_dir):
+            os.makedirs(tmp_dir)
+        filepath = os.path.join(tmp_dir, os.path.basename(data.path))
+        print(f"Downloading {inventory_uri}")
+        s3_client = boto3.client('s3')
+        s3_client.download_file(data.bucket, data.path.lstrip('/'), filepath)
+        return filepath, True
+    elif data.store == 'file':
+        return data.path, False
+    elif data.store == '':
+        return inventory_uri, False
+    else:
+        raise Exception(f"Unknown data scheme: {data.store}")
+
+def add_rows_to_inventory(inventory, rows):
+    for key, size in rows:
+        # delete markers have no size
+        if not key or size in (None, ''):
+            continue
+        digest = key.rstrip('/').split('/')[-1]
+        inventory[digest] = int(size)
+
+def read_csv_inventory(filepath, columns=None):
+    '''
+    Yield (key, size) for each row of a csv inventory. If columns
+    aren't given (as they are for S3 Inventory data files, which have
+    no header), the first row must be a header.
+    '''
+    open_file = gzip.open if filepath.endswith('.gz') else open
+    with open_file(filepath, "rt", newline='') as f:
+        reader = csv.reader(f)
+        if columns is None:
+            columns = next(reader, [])
+
+        columns = [column.strip().lower() for column in columns]
+        key_columns = [c for c in ('digest', 'key') if c in columns]
+        size_columns = [c for c in ('length', 'size') if c in columns]
+        if not key_columns or not size_columns:
+            raise Exception(
+                f"No digest/key and length/size columns in inventory {filepath}. "
+                "For an S3 Inventory, use its manifest.json."
+            )
+        key_index = columns.index(key_columns[0])
+        size_index = columns.index(size_columns[0])
+
+        for row in reader:
+            if not row:
+                continue
+            if len(row) <= max(key_index, size_index):
+                raise Exception(
+                    f"Row {reader.line_num} of inventory {filepath} has "
+                    f"{len(row)} columns; expected at least {max(key_index, size_index) + 1}"
+                )
+            yield unquote(row[key_index]), row[size_index]
+
+def read_parquet_inventory(filepath):
+    ''' Yield (key, size) for each row of a parquet inventory '''
+    table = pq.read_table(filepath)
+    key_column = 'digest' if 'digest' in table.column_names else 'key'
+    size_column = 'length' if 'length' in table.column_names else 'size'
+    yield from zip(
+        table.column(key_column).to_pylist(),
+        table.column(size_column).to_pylist()
+    )
+
 def hit_nuxeo_api(uid):
     ''' Hit the Nuxeo API to get full record metadata '''
     url = u'/'.join([NUXEO_API_URL, "id", uid])
@@ -519,16 +986,21 @@ def write_stats(stats, worksheet, rownum, rowname):
         worksheet.write(rownum, col, d)
         col = col + 1
 
-def fetch_records(root: dict, campus: str, version: str):
+def fetch_records(root: dict, campus: str, version: str, page_queue: queue.Queue = None, results_type: str = 'listing', component_workers: int = 1):
     '''
         Fetch a listing of all records for a given root document
         in batches (pages) of 100, and write each page to storage.
+        If a page_queue is given, each page is also put on the queue
+        as a (path, records) tuple once it has been written.
+        Use results_type 'full' to store full metadata for each record.
+        If component_workers is more than 1, components are looked for
+        with that many concurrent requests.
     '''
     next_page = True
     resume_after = ''
     write_page = 0
     while next_page:
-        resp = query_nuxeo_db_directly(root, 'records', 'listing', resume_after)
+        resp = query_nuxeo_db_directly(root, 'records', results_type, resume_after)
         next_page = resp.json().get('isNextPageAvailable')
         resume_after = resp.json().get('resumeAfter')
         records = resp.json().get('entries', [])
@@ -539,31 +1011,43 @@ def fetch_records(root: dict, campus: str, version: str):
 
         # write page of parent records to storage
         store_page_of_records(records, root['path'], campus, version, write_page)
+        if page_queue is not None:
+            page_queue.put((root['path'], records))
         write_page += 1
 
         # get any component records and write to storage
+        child_pages = None
+        if component_workers > 1:
+            child_pages = get_pages_of_descendant_components_concurrently(records, results_type, component_workers)
         for record in records:
-            fetch_components(record, campus, version, root)
+            fetch_components(record, campus, version, root, page_queue, results_type, child_pages)
 
-def fetch_components(root_record: dict, campus: str, version: str, folder: dict):
+def fetch_components(root_record: dict, campus: str, version: str, folder: dict, page_queue: queue.Queue = None, results_type: str = 'listing', child_pages: dict = None):
     '''
     Fetch pages of components for a given record uid
     It is possible for components to be nested inside components; in the case
     of multiple layers, the hierarchy is ignored and all layers of components
     are considered to to be children of the root record.
+    If child_pages (see get_pages_of_descendant_components_concurrently) is given, pages
+    of components are looked up there instead of being fetched.
     '''
     component_pages = []
 
+    def get_child_pages(record):
+        if child_pages is not None:
+            return child_pages[record['uid']]
+        return get_pages_of_child_components(record, results_type)
+
     def recurse(pages):
         component_pages.extend(pages)
         for page in pages:
             records = page.get('entries', [])
             for record in records:
-                child_component_pages = get_pages_of_child_components(record)
+                child_component_pages = get_child_pages(record)
                 recurse(child_component_pages)
 
     # get components of root record
-    root_component_pages = get_pages_of_child_components(root_record)
+    root_component_pages = get_child_pages(root_record)
 
     # recurse down the tree to fetch any nested components
     recurse(root_component_pages)
@@ -575,15 +1059,46 @@ def fetch_components(root_record: dict, campus: str, version: str, folder: dict)
         path = f"{folder['path']}/children"
         page_name = f"{root_record['uid']}-{page_count}"
         store_page_of_records(records, path, campus, version, page_name)
+        if page_queue is not None:
+            page_queue.put((path, records))
         page_count += 1
 
 
-def get_pages_of_child_components(record: dict):
+def get_pages_of_descendant_components_concurrently(records: list, results_type: str = 'listing', workers: int = 10):
+    '''
+    Fetch pages of child components for a list of records and all of
+    their descendant components, one level of nesting at a time, with
+    up to `workers` concurrent requests. This makes the same requests
+    as fetch_components (one per record, including records that turn out
+    to have no components), it just doesn't wait for each one before
+    making the next. It adds load on the dbquery endpoint and does not
+    reduce the number of requests.
+
+    Returns a dict of record uid -> pages of child components
+    '''
+    child_pages = {}
+    level = records
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while level:
+            level_pages = executor.map(
+                lambda record: get_pages_of_child_components(record, results_type),
+                level
+            )
+            next_level = []
+            for record, pages in zip(level, level_pages):
+                child_pages[record['uid']] = pages
+                for page in pages:
+                    next_level.extend(page.get('entries', []))
+            level = next_level
+
+    return child_pages
+
+def get_pages_of_child_components(record: dict, results_type: str = 'listing'):
     next_page = True
     resume_after = ''
     components = []
     while next_page:
-        resp = query_nuxeo_db_directly(record, 'records', 'listing', resume_after)
+        resp = query_nuxeo_db_directly(record, 'records', results_type, resume_after)
         next_page = resp.json().get('isNextPageAvailable')
         resume_after = resp.json().get('resumeAfter')
         records = resp.json().get('entries', [])
@@ -646,28 +1161,84 @@ def store_page_of_records(records: list, path: str, campus: str, version: str, p
         load_object_to_s3(DATA.bucket, s3_key, jsonl)
 
 
+def fetch_campus_metadata(campus: str, version: str, page_queue: queue.Queue = None, results_type: str = 'listing', component_workers: int = 1):
+    ''' Fetch metadata for all folders in a campus from nuxeo to storage '''
+    path = f"/asset-library/{campus}"
+    uid = get_nuxeo_uid_for_path(path)
+    for folder in fetch_folders({'uid': uid}):
+        fetch_records(folder, campus, version, page_queue, results_type, component_workers)
+
+# max number of pages of records waiting to be aggregated
+PAGE_QUEUE_SIZE = 50
+
+def stream_extent_report(campus: str, version: str, inventory: dict = None, component_workers: int = 1):
+    '''
+    Fetch metadata from nuxeo to storage in a background thread, while
+    aggregating stats for each page of records as soon as it is fetched,
+    so that the fetch and the report overlap instead of running one
+    after the other. The queue is bounded so the crawl can't get too
+    far ahead of the aggregation.
+    '''
+    page_queue = queue.Queue(maxsize=PAGE_QUEUE_SIZE)
+    results_type = 'listing' if inventory is None else 'full'
+
+    def crawl():
+        try:
+            fetch_campus_metadata(campus, version, page_queue, results_type, component_workers)
+        except Exception as e:
+            page_queue.put(e)
+        else:
+            page_queue.put(None)
+
+    crawler = threading.Thread(target=crawl, daemon=True)
+    crawler.start()
+    create_extent_report(campus, version, page_queue, inventory)
+    crawler.join()
+
+def sample_size(value):
+    size = int(value)
+    if size < 2:
+        raise argparse.ArgumentTypeError("sample size must be at least 2")
+    return size
+
 def main(params):
+    global HTTP_SESSION
+    if params.component_workers > 1:
+        # make sure there is a pooled connection for each concurrent request
+        HTTP_SESSION = configure_http_session(max(10, params.component_workers))
+
     if params.campus:
         campuses = [params.campus]
     elif params.all:
         campuses = CAMPUSES
 
+    if params.inventory:
+        inventory = load_blob_inventory(params.inventory)
+        results_type = 'full'
+    else:
+        inventory = None
+        results_type = 'listing'
+
     for campus in campuses:
         print("**********************")
         print(f"******   {campus}   ******")
         print("**********************")
 
+        if params.sample is not None:
+            create_extent_estimate(campus, params.version, params.sample)
+            continue
+
         if params.version:
             version = params.version
         else:
             # fetch metadata from scratch from nuxeo
             version = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
-            path = f"/asset-library/{campus}"
-            uid = get_nuxeo_uid_for_path(path)
-            for folder in fetch_folders({'uid': uid}):
-                fetch_records(folder, campus, version)
+            if params.stream:
+                stream_extent_report(campus, version, inventory, params.component_workers)
+                continue
+            fetch_campus_metadata(campus, version, results_type=results_type, component_workers=params.component_workers)
 
-        create_extent_report(campus, version)
+        create_extent_report(campus, version, inventory=inventory)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="create nuxeo extent stats report(s)")
@@ -675,6 +1246,13 @@ if __name__ == "__main__":
     top_folder.add_argument('--all', help="create reports for all campuses", action="store_true")
     top_folder.add_argument('--campus', help="single campus")
     parser.add_argument('--version', help="Metadata version. If provided, metadata will be fetched from S3.")
+    report_mode = parser.add_mutually_exclusive_group()
+    report_mode.add_argument('--stream', help="Create the report while metadata is being fetched from nuxeo. Ignored if --version is provided.", action="store_true")
+    report_mode.add_argument('--sample', type=sample_size, metavar='N', help="Estimate extent from a random sample of N docs per folder instead of creating a full report.")
+    parser.add_argument('--component-workers', type=int, default=1, metavar='N', help="Number of concurrent requests to make when looking for child components while fetching metadata. Every record still costs one request; this only overlaps them. Defaults to 1 (sequential).")
+    parser.add_argument('--inventory', help="Path or S3 uri of a binary store inventory (csv or parquet). If provided, sizes are looked up in the inventory by digest instead of fetching each doc from the Nuxeo API. Metadata must also have been fetched with --inventory.")
 
     args = parser.parse_args()
+    if args.inventory and args.sample is not None:
+        parser.error("argument --inventory: not allowed with argument --sample")
     sys.exit(main(args))
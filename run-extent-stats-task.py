@@ -12,6 +12,14 @@ def main(args):
         campus = args.campus
     if args.version:
         command.extend(["--version", args.version])
+    if args.stream:
+        command.append("--stream")
+    if args.component_workers:
+        command.extend(["--component-workers", str(args.component_workers)])
+    if args.inventory:
+        command.extend(["--inventory", args.inventory])
+    if args.sample is not None:
+        command.extend(["--sample", str(args.sample)])
 
     # assume we"re running this in the pad-dsc-admin account for now
     cluster = "nuxeo"
@@ -59,12 +67,25 @@ def main(args):
     
     print(f"ECS task {task_arn} was started.")
               
+def sample_size(value):
+    size = int(value)
+    if size < 2:
+        raise argparse.ArgumentTypeError("sample size must be at least 2")
+    return size
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="create nuxeo extent stats report(s)")
     top_folder = parser.add_mutually_exclusive_group(required=True)
     top_folder.add_argument("--all", help="create reports for all campuses", action="store_true")
     top_folder.add_argument("--campus", help="single campus")
     parser.add_argument("--version", help="Metadata version. If not provided, metadata will be fetched from S3.")
+    report_mode = parser.add_mutually_exclusive_group()
+    report_mode.add_argument("--stream", help="Create the report while metadata is being fetched.", action="store_true")
+    report_mode.add_argument("--sample", type=sample_size, metavar="N", help="Estimate extent from a random sample of N docs per folder.")
+    parser.add_argument("--component-workers", type=int, metavar="N", help="Number of concurrent requests to make when looking for child components.")
+    parser.add_argument("--inventory", help="S3 uri of a binary store inventory to get file sizes from.")
 
     args = parser.parse_args()
+    if args.inventory and args.sample is not None:
+        parser.error("argument --inventory: not allowed with argument --sample")
     (main(args))
\ No newline at end of file